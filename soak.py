@@ -0,0 +1,344 @@
+"""Soak and regression harness for the useless machine trigger/action loop.
+
+Runs useless_machine.py off-device against a stand-in I2C bus and trigger
+button, with a virtual clock replacing time.sleep, and drives the trigger
+loop for as many simulated presses as requested. Memory growth, timing drift,
+I2C error injection/recovery and throughput (presses per virtual second) are
+sampled every window and the run fails (exit status 1) if any metric crosses
+its threshold. The host's own press rate is printed but never checked.
+
+Example:
+    python soak.py --presses 1000000 --error-rate 0.0005 --error-burst 3
+"""
+import argparse
+import errno
+import importlib
+import random
+import sys
+import time
+import tracemalloc
+import types
+
+
+class VirtualClock:
+    "Stands in for the time module, sleeping only advances a counter"
+
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+class FaultInjector:
+    "Decides which bus transfers fail, failures come in bursts"
+
+    def __init__(self, rate=0.0, burst=1, seed=None):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.enabled = False
+        self.injected = 0
+        self._random = random.Random(seed)
+        self._remaining = 0
+
+    def check(self):
+        "Raises OSError if the next transfer should fail"
+        if not self.enabled:
+            return
+        if self._remaining == 0 and self.rate and self._random.random() < self.rate:
+            self._remaining = self.burst
+        if self._remaining:
+            self._remaining -= 1
+            self.injected += 1
+            raise OSError(errno.EREMOTEIO, "Remote I/O error (injected)")
+
+    def acked(self, length):
+        "How many bytes of a failed block write the device latched first"
+        return self._random.randrange(length)
+
+
+class FakeSMBus:
+    "Stand-in for smbus.SMBus, the register file outlives any one bus handle"
+
+    faults = FaultInjector()
+    registers = {}
+    writes = 0
+    reads = 0
+
+    def __init__(self, bus=None):
+        self.bus = bus
+        self.closed = False
+
+    def write_byte_data(self, address, reg, value):
+        if self.closed:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        self.faults.check()
+        if not 0 <= value <= 0xFF:
+            raise ValueError("byte value out of range: %r" % value)
+        FakeSMBus.registers[(address, reg)] = value
+        FakeSMBus.writes += 1
+
+    def write_i2c_block_data(self, address, reg, data):
+        if self.closed:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        if any(not 0 <= value <= 0xFF for value in data):
+            raise ValueError("byte value out of range: %r" % (data,))
+        # Without MODE1 auto-increment every byte lands on the same register.
+        step = 1 if FakeSMBus.registers.get((address, 0x00), 0) & 0x20 else 0
+        try:
+            self.faults.check()
+        except OSError:
+            latched = self.faults.acked(len(data))
+            for i in range(latched):
+                FakeSMBus.registers[(address, reg + step * i)] = data[i]
+            raise
+        for i, value in enumerate(data):
+            FakeSMBus.registers[(address, reg + step * i)] = value
+        FakeSMBus.writes += 1
+
+    def read_byte_data(self, address, reg):
+        if self.closed:
+            raise OSError(errno.EBADF, "Bad file descriptor")
+        self.faults.check()
+        FakeSMBus.reads += 1
+        return FakeSMBus.registers.get((address, reg), 0)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeButton:
+    "Stand-in for gpiozero.Button, the harness decides when it is pressed"
+
+    def __init__(self, pin, *args, **kwargs):
+        self.pin = pin
+        self.is_pressed = False
+
+
+def load_machine(clock):
+    "Imports useless_machine with the stand-in bus, button and clock"
+    smbus = types.ModuleType("smbus")
+    smbus.SMBus = FakeSMBus
+    gpiozero = types.ModuleType("gpiozero")
+    gpiozero.Button = FakeButton
+    sys.modules["smbus"] = smbus
+    sys.modules["gpiozero"] = gpiozero
+    sys.modules.pop("useless_machine", None)
+
+    real_sleep = time.sleep
+    time.sleep = clock.sleep  # import runs setPWMFreq, which sleeps
+    try:
+        machine = importlib.import_module("useless_machine")
+    finally:
+        time.sleep = real_sleep
+    machine.time = clock
+    machine.print = lambda *args, **kwargs: None  # keep the device's error log out of the report
+    return machine
+
+
+def channel_value(machine, channel):
+    "Decodes the ON/OFF counts currently held in a channel's registers"
+    regs = FakeSMBus.registers
+    base = 0x06 + 4 * channel
+    address = machine.pwm.address
+    on = regs.get((address, base), 0) | regs.get((address, base + 1), 0) << 8
+    off = regs.get((address, base + 2), 0) | regs.get((address, base + 3), 0) << 8
+    return on, off
+
+
+def servo_count(pulse):
+    "OFF count setServoPulse writes for a pulse width in microseconds"
+    return int(pulse * 4096 / 20000)
+
+
+# The arm may only be out while the lid is open; 2300 is the lowest pulse
+# the actions use for a closed lid.
+ARM_CLOSED = servo_count(2450)
+LID_CLOSED = servo_count(2300)
+
+
+class Metrics:
+    "Running totals and per-window samples for a soak run"
+
+    def __init__(self):
+        self.presses = 0
+        self.escaped_errors = 0
+        self.torn_channels = 0
+        self.order_violations = 0
+        self.dropped_updates = 0
+        self.failed_rollbacks = 0
+        self.nominal = {}
+        self.max_drift = 0.0
+        self.max_drift_action = None
+        self.memory = []
+        self.throughput = []  # presses per virtual second, what the device sees
+        self.host_rate = []   # presses per wall-clock second, reported only
+
+
+def run(args):
+    clock = VirtualClock()
+    FakeSMBus.faults = FaultInjector(args.error_rate, args.error_burst, args.seed)
+    FakeSMBus.registers = {}
+    FakeSMBus.writes = FakeSMBus.reads = 0
+    machine = load_machine(clock)
+    machine.random.seed(args.seed)
+
+    # Every (on, off) pair the actions asked for, per channel. Anything else
+    # found in the registers after a press is a torn update.
+    commanded = {}
+    set_pwm = machine.pwm.setPWM
+    channels = (machine.lid_servo_channel, machine.arm_servo_channel, machine.flag_servo_channel)
+    metrics = Metrics()
+
+    def recording_set_pwm(channel, on, off):
+        commanded.setdefault(channel, set()).add((on, off))
+        try:
+            set_pwm(channel, on, off)
+        finally:
+            if channel != machine.flag_servo_channel:
+                check_order()
+
+    def check_order():
+        arm_out = channel_value(machine, machine.arm_servo_channel)[1] < ARM_CLOSED
+        lid_closed = channel_value(machine, machine.lid_servo_channel)[1] >= LID_CLOSED
+        if arm_out and lid_closed:
+            metrics.order_violations += 1
+
+    machine.pwm.setPWM = recording_set_pwm
+    machine.set_default_positions()
+
+    def check_channels():
+        for channel in channels:
+            if channel_value(machine, channel) not in commanded.get(channel, ()):
+                metrics.torn_channels += 1
+
+    faults = FakeSMBus.faults
+    faults.enabled = True
+    tracemalloc.start()
+    window_start = time.perf_counter()
+    window_virtual_start = clock.now
+    window_errors = 0
+
+    for press in range(1, args.presses + 1):
+        injected_before = faults.injected
+        started = clock.now
+        machine.trigger_button.is_pressed = True
+        action = machine.run_once()
+        machine.trigger_button.is_pressed = False
+        if action is None:
+            # With the button held, run_once only returns None when the
+            # action failed and it re-homed the servos.
+            metrics.escaped_errors += 1
+        metrics.presses = press
+        window_errors += faults.injected - injected_before
+        check_channels()
+
+        if action is not None:
+            duration = clock.now - started
+            if faults.injected == injected_before:
+                metrics.nominal.setdefault(action, duration)
+            nominal = metrics.nominal.get(action)
+            if nominal is not None:
+                drift = abs(duration - nominal)
+                if drift > metrics.max_drift:
+                    metrics.max_drift = drift
+                    metrics.max_drift_action = action
+
+        if press % args.window == 0 or press == args.presses:
+            elapsed = time.perf_counter() - window_start
+            virtual_elapsed = clock.now - window_virtual_start
+            window = press - (metrics.throughput[-1][0] if metrics.throughput else 0)
+            metrics.throughput.append((press, window / virtual_elapsed if virtual_elapsed else float("inf")))
+            metrics.host_rate.append((press, window / elapsed if elapsed else float("inf")))
+            metrics.memory.append((press, tracemalloc.get_traced_memory()[0]))
+            if not args.quiet:
+                print("presses: %d  device: %.4f/s  host: %.0f/s  memory: %d B  injected: %d  escaped: %d  torn: %d  drift: %.3fs  virtual: %.0fs"
+                      % (press, metrics.throughput[-1][1], metrics.host_rate[-1][1], metrics.memory[-1][1],
+                         window_errors, metrics.escaped_errors, metrics.torn_channels, metrics.max_drift, clock.now))
+            window_errors = 0
+            window_start = time.perf_counter()
+            window_virtual_start = clock.now
+
+    tracemalloc.stop()
+    metrics.dropped_updates = machine.pwm.dropped_updates
+    metrics.failed_rollbacks = machine.pwm.failed_rollbacks
+    return metrics, faults, machine.pwm.stats()
+
+
+def check_thresholds(args, metrics):
+    "Returns a list of threshold violations"
+    failures = []
+    if metrics.escaped_errors > args.max_escaped_errors:
+        failures.append("%d I2C errors escaped the trigger loop (max %d)"
+                        % (metrics.escaped_errors, args.max_escaped_errors))
+    if metrics.torn_channels > args.max_torn_channels:
+        failures.append("%d torn channel updates (max %d)" % (metrics.torn_channels, args.max_torn_channels))
+    if metrics.order_violations:
+        failures.append("arm was out while the lid was closed %d times" % metrics.order_violations)
+    if metrics.dropped_updates > args.max_dropped_updates:
+        failures.append("%d channel updates dropped (max %d)" % (metrics.dropped_updates, args.max_dropped_updates))
+    if metrics.failed_rollbacks > args.max_failed_rollbacks:
+        failures.append("%d failed updates left a channel unknown (max %d)"
+                        % (metrics.failed_rollbacks, args.max_failed_rollbacks))
+    if metrics.max_drift > args.max_drift:
+        failures.append("action%s drifted %.3fs from its nominal duration (max %.3fs)"
+                        % (metrics.max_drift_action, metrics.max_drift, args.max_drift))
+    # The first window includes warm-up allocations, so measure from the second.
+    if len(metrics.memory) > 2:
+        growth = metrics.memory[-1][1] - metrics.memory[1][1]
+        if growth > args.max_memory_growth:
+            failures.append("memory grew by %d B (max %d B)" % (growth, args.max_memory_growth))
+    # Throughput is judged in virtual time, where retry backoff slows the
+    # device; a short final window is too noisy to compare.
+    full = [rate for press, rate in metrics.throughput if press % args.window == 0]
+    if len(full) > 1:
+        baseline = full[0]
+        worst = min(full)
+        if worst < baseline * args.min_throughput_ratio:
+            failures.append("throughput fell to %.4f presses/s from %.4f presses/s of virtual time (min ratio %.2f)"
+                            % (worst, baseline, args.min_throughput_ratio))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test the trigger/action loop against a stand-in I2C bus")
+    parser.add_argument("--presses", type=int, default=1000000, help="simulated button presses")
+    parser.add_argument("--window", type=int, default=10000, help="presses per sample window")
+    parser.add_argument("--seed", type=int, default=0, help="seed for action choice and fault injection")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability an I2C transfer starts failing")
+    parser.add_argument("--error-burst", type=int, default=1, help="consecutive transfers that fail per error")
+    parser.add_argument("--max-escaped-errors", type=int, default=0, help="I2C errors allowed to reach the trigger loop")
+    parser.add_argument("--max-torn-channels", type=int, default=0, help="torn channel updates allowed")
+    parser.add_argument("--max-dropped-updates", type=int, default=0, help="channel updates rolled back by the driver allowed")
+    parser.add_argument("--max-failed-rollbacks", type=int, default=0, help="failed updates the driver could not roll back allowed")
+    parser.add_argument("--max-drift", type=float, default=0.25, help="seconds an action may drift from its nominal duration")
+    parser.add_argument("--max-memory-growth", type=int, default=1 << 20, help="bytes of traced memory growth allowed")
+    parser.add_argument("--min-throughput-ratio", type=float, default=0.5, help="slowest window / first window, in presses per virtual second")
+    parser.add_argument("--quiet", action="store_true", help="only print the summary")
+    args = parser.parse_args(argv)
+    if args.presses < 1 or args.window < 1:
+        parser.error("--presses and --window must be positive")
+
+    metrics, faults, stats = run(args)
+    print("Soak finished: %d presses, %d I2C errors injected, %d escaped, %d torn, %d out of order, max drift %.3fs"
+          % (metrics.presses, faults.injected, metrics.escaped_errors,
+             metrics.torn_channels, metrics.order_violations, metrics.max_drift))
+    print("Bus: %d writes, %d reads" % (FakeSMBus.writes, FakeSMBus.reads))
+    print("Driver: " + ", ".join("%s %d" % item for item in stats.items()))
+
+    failures = check_thresholds(args, metrics)
+    for failure in failures:
+        print("FAIL: " + failure)
+    if not failures:
+        print("PASS")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
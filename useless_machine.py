@@ -3,6 +3,72 @@ import math
 import smbus
 from gpiozero import Button
 
+# I2C bus access with bounded retry, backoff and bus reopen
+class I2CTransport:
+    def __init__(self, busnum=1, max_retries=3, backoff=0.001, max_backoff=0.02, reset_after=3, debug=False):
+        self.busnum = busnum
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reset_after = reset_after
+        self.debug = debug
+        self.errors = 0     # transfers that raised
+        self.retries = 0    # transfers attempted again
+        self.resets = 0     # times the bus was reopened
+        self.failures = 0   # transfers given up on
+        self.consecutive_errors = 0
+        self.bus = smbus.SMBus(busnum)
+
+    def transfer(self, method, *args):
+        "Runs a bus transfer, retrying with backoff and reopening the bus on repeated failure"
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = getattr(self.bus, method)(*args)
+                self.consecutive_errors = 0
+                return result
+            except OSError as e:
+                self.errors += 1
+                self.consecutive_errors += 1
+                if self.debug:
+                    print("I2C: %s failed (attempt %d): %s" % (method, attempt + 1, e))
+                if self.consecutive_errors >= self.reset_after:
+                    self.reset()
+                if attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+            self.retries += 1
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def reset(self):
+        "Closes and reopens the bus"
+        if self.debug:
+            print("I2C: Reopening bus %d" % self.busnum)
+        try:
+            self.close()
+        except OSError:
+            pass
+        try:
+            self.bus = smbus.SMBus(self.busnum)
+        except OSError:
+            pass  # keep the old handle, the next attempt fails and retries
+        self.resets += 1
+        self.consecutive_errors = 0
+
+    def close(self):
+        "Closes the bus"
+        self.bus.close()
+
+    def write_byte_data(self, address, reg, value):
+        self.transfer("write_byte_data", address, reg, value)
+
+    def write_i2c_block_data(self, address, reg, data):
+        self.transfer("write_i2c_block_data", address, reg, data)
+
+    def read_byte_data(self, address, reg):
+        return self.transfer("read_byte_data", address, reg)
+
 # Raspi PCA9685 16-Channel PWM Servo Driver
 class PCA9685:
     __SUBADR1 = 0x02
@@ -20,12 +86,15 @@ class PCA9685:
     __ALLLED_OFF_H = 0xFD
 
     def __init__(self, address=0x40, debug=False):
-        self.bus = smbus.SMBus(1)
+        self.bus = I2CTransport(1, debug=debug)
         self.address = address
         self.debug = debug
+        self.channels = {}  # last (on, off) fully written to each channel
+        self.dropped_updates = 0  # channel updates abandoned and rolled back
+        self.failed_rollbacks = 0  # failed updates that left a channel unknown
         if self.debug:
             print("Resetting PCA9685")
-        self.write(self.__MODE1, 0x00)
+        self.write(self.__MODE1, 0x20)  # auto-increment, lets a channel be written in one transfer
 
     def write(self, reg, value):
         "Writes an 8-bit value to the specified register/address"
@@ -61,15 +130,48 @@ class PCA9685:
         time.sleep(0.005)
         self.write(self.__MODE1, oldmode | 0x80)
 
+    def writeChannel(self, channel, on, off):
+        "Writes the four ON/OFF registers of a PWM channel in a single transfer"
+        data = [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+        self.bus.write_i2c_block_data(self.address, self.__LED0_ON_L + 4 * channel, data)
+
     def setPWM(self, channel, on, off):
-        "Sets a single PWM channel"
-        self.write(self.__LED0_ON_L + 4 * channel, on & 0xFF)
-        self.write(self.__LED0_ON_H + 4 * channel, on >> 8)
-        self.write(self.__LED0_OFF_L + 4 * channel, off & 0xFF)
-        self.write(self.__LED0_OFF_H + 4 * channel, off >> 8)
+        "Sets a single PWM channel, if the update fails the last good value is restored and the error raised"
+        try:
+            self.writeChannel(channel, on, off)
+        except OSError:
+            # A transfer cut short may still have latched some bytes.
+            last = self.channels.pop(channel, None)
+            if last is not None:
+                try:
+                    self.writeChannel(channel, *last)
+                except OSError:
+                    last = None
+            if last is None:
+                self.failed_rollbacks += 1
+                if self.debug:
+                    print("channel: %d  update failed, contents unknown" % channel)
+            else:
+                self.channels[channel] = last
+                self.dropped_updates += 1
+                if self.debug:
+                    print("channel: %d  update dropped, restored LED_ON: %d LED_OFF: %d" % (channel, last[0], last[1]))
+            raise  # the next step of the action assumes this one happened
+        self.channels[channel] = (on, off)
         if self.debug:
             print("channel: %d  LED_ON: %d LED_OFF: %d" % (channel, on, off))
 
+    def stats(self):
+        "Returns the I2C error and retry counters"
+        return {
+            "errors": self.bus.errors,
+            "retries": self.bus.retries,
+            "resets": self.bus.resets,
+            "failures": self.bus.failures,
+            "dropped_updates": self.dropped_updates,
+            "failed_rollbacks": self.failed_rollbacks,
+        }
+
     def setServoPulse(self, channel, pulse):
         "Sets the Servo Pulse, The PWM frequency must be 50HZ"
         pulse = pulse * 4096 / 20000  # PWM frequency is 50HZ, the period is 20000us
@@ -687,7 +789,30 @@ def action50():
 
 # Main loop
 import random
-while True:
+
+def handle_trigger():
+    "Runs a random action if the trigger button is pressed, returns its number"
     if trigger_button.is_pressed:
         action = random.randint(1, 50)
         globals()[f'action{action}']()
+        return action
+    return None
+
+def run_once():
+    "Runs one pass of the main loop, returning to default positions if an action fails"
+    try:
+        return handle_trigger()
+    except OSError as e:
+        print("I2C error, returning to default positions: %s %s" % (e, pwm.stats()))
+        try:
+            set_default_positions()
+        except OSError as e:
+            print("I2C error, default positions not restored: %s" % e)
+    return None
+
+if __name__ == "__main__":
+    try:
+        while True:
+            run_once()
+    finally:
+        pwm.bus.close()